@@ -0,0 +1,382 @@
+import logging
+from collections import defaultdict
+
+import pandas as pd
+
+# administrative suffixes that one source spells out and another drops,
+# e.g. 'autauga county' (google) vs 'autauga' (nyt / jhu)
+region_suffixes = [
+    ' city and borough',
+    ' census area',
+    ' municipality',
+    ' municipio',
+    ' borough',
+    ' parish',
+    ' county',
+]
+
+# abbreviations that are spelled differently across the sources
+token_aliases = {
+    'st.': 'saint',
+    'st': 'saint',
+    'ste.': 'sainte',
+    'ste': 'sainte',
+}
+
+# tokens that distinguish two regions of the same state, like the
+# independent city 'franklin city' and the county 'franklin'
+distinguishing_tokens = {'city'}
+
+# separator of the (sub_region_1, sub_region_2) lookup key
+key_sep = '|'
+
+# suffix of the independent cities in the other sources, like 'baltimore city'
+# (nyt / jhu) vs 'baltimore' (google)
+city_suffix = ' city'
+
+
+def normalize_name(name):
+    """Lower-case a region name and collapse blanks
+
+    Args:
+        name (str): region name
+
+    Returns:
+        str: normalized name, or NaN if the name is missing
+    """
+    if pd.isna(name):
+        return name
+    return ' '.join(str(name).lower().split())
+
+
+def strip_suffix(name):
+    """Remove the trailing administrative suffix of a region name
+
+    Only a trailing suffix is removed, so that names like 'carson city' or
+    'james city county' keep the words that belong to them.
+
+    Args:
+        name (str): region name
+
+    Returns:
+        str: name without suffix, or NaN if the name is missing
+    """
+    name = normalize_name(name)
+    if pd.isna(name):
+        return name
+    for suffix in region_suffixes:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def normalize_series(names):
+    """Vectorized version of normalize_name
+
+    Args:
+        names (pandas.Series): region names
+
+    Returns:
+        pandas.Series: normalized names
+    """
+    mapping = {name: normalize_name(name) for name in names.dropna().unique()}
+    return names.map(mapping).astype(object)
+
+
+def canonicalize_series(names, states):
+    """Generate the canonical form of county level region names
+
+    The administrative suffix is removed only if the result stays unique
+    within the state. Otherwise, like for 'baltimore' and 'baltimore county',
+    the full names are kept so that the two regions are not merged.
+
+    The canonical form is computed once per distinct (state, name) pair,
+    every row is then resolved by a single dictionary lookup.
+
+    Args:
+        names (pandas.Series): county names
+        states (pandas.Series): state names
+
+    Returns:
+        pandas.Series: canonical names
+    """
+    states = states.fillna('').astype(object)
+    names = names.astype(object)
+    pairs = pd.DataFrame({'state': states, 'name': names}).dropna().drop_duplicates()
+
+    full_names = defaultdict(set)
+    for state, name in pairs.itertuples(index=False):
+        full_names[(normalize_name(state), strip_suffix(name))].add(normalize_name(name))
+
+    mapping = {}
+    for state, name in pairs.itertuples(index=False):
+        stripped = strip_suffix(name)
+        if len(full_names[(normalize_name(state), stripped)]) == 1:
+            mapping[state + key_sep + name] = stripped
+        else:
+            mapping[state + key_sep + name] = normalize_name(name)
+
+    return states.str.cat(names, sep=key_sep).map(mapping)
+
+
+def spelling_variants(name):
+    """Generate the known spelling variants of a canonical name
+
+    Args:
+        name (str): canonical name
+
+    Returns:
+        set(str): variants, including the name itself
+    """
+    variants = {name}
+    tokens = name.split()
+    expanded = [token_aliases.get(token, token) for token in tokens]
+    variants.add(' '.join(expanded))
+    for variant in list(variants):
+        variants.add(variant.replace('.', ''))
+    return variants
+
+
+def suffix_variants(name):
+    """Generate the spelling variants of a canonical name with a suffix
+
+    Args:
+        name (str): canonical name
+
+    Returns:
+        set(str): variants
+    """
+    return {variant + suffix for variant in spelling_variants(name)
+            for suffix in region_suffixes}
+
+
+def ngrams(name, n=3):
+    """Character n-grams of a name, padded with blanks
+
+    Args:
+        name (str): name
+        n (int): n-gram length
+
+    Returns:
+        set(str): n-grams
+    """
+    padded = ' {} '.format(name)
+    return {padded[i: i + n] for i in range(len(padded) - n + 1)}
+
+
+def make_keys(sub_region_1, sub_region_2):
+    """Build the lookup keys of (sub_region_1, sub_region_2) pairs
+
+    Args:
+        sub_region_1 (pandas.Series): state names
+        sub_region_2 (pandas.Series): county names
+
+    Returns:
+        pandas.Series: keys
+    """
+    return normalize_series(sub_region_1).str.cat(normalize_series(sub_region_2), sep=key_sep)
+
+
+class AliasIndex(object):
+    """Precomputed index from region name aliases to canonical names
+
+    The canonical names are the county level names of the right table (google
+    mobility data). Every canonical name is registered together with its known
+    spelling variants, and the names of the other sources that have no exact
+    variant are matched once, when the index is built, against an n-gram
+    index of the canonical names. A left table column is then resolved by one
+    dictionary lookup.
+
+    Args:
+        sub_region_1 (pandas.Series): state names of the canonical vocabulary
+        sub_region_2 (pandas.Series): county names of the canonical vocabulary
+        min_similarity (float): minimum n-gram similarity of a near-miss
+    """
+
+    def __init__(self, sub_region_1, sub_region_2, min_similarity=0.6):
+        self.min_similarity = min_similarity
+        self.aliases = {}
+        self.ngram_index = defaultdict(set)
+        self.reported = set()
+
+        vocabulary = pd.DataFrame({
+            'sub_region_1': normalize_series(sub_region_1),
+            'sub_region_2': normalize_series(sub_region_2),
+        }).dropna().drop_duplicates()
+
+        for state, county in vocabulary.itertuples(index=False):
+            self.aliases[state + key_sep + county] = county
+            for gram in ngrams(county):
+                self.ngram_index[state + key_sep + gram].add(county)
+
+        # when a state has both 'baltimore' and 'baltimore county', google's
+        # bare name is the independent city. The other sources call the city
+        # 'baltimore city' and the county 'baltimore', so the bare name of a
+        # left table is the county. These aliases take precedence over the
+        # exact names
+        counties = set(self.aliases)
+        for state, county in vocabulary.itertuples(index=False):
+            for suffix in region_suffixes:
+                if state + key_sep + county + suffix not in counties:
+                    continue
+                for variant in spelling_variants(county):
+                    self.aliases[state + key_sep + variant] = county + suffix
+                    self.aliases[state + key_sep + variant + city_suffix] = county
+                break
+
+        # a variant that is shared by two canonical names of the same state
+        # is ambiguous and will not be registered. Spelling variants take
+        # precedence over the added suffixes, so that 'st louis county' is
+        # 'st. louis county' rather than 'st. louis'
+        for variants in [spelling_variants, suffix_variants]:
+            candidates = defaultdict(set)
+            for state, county in vocabulary.itertuples(index=False):
+                for variant in variants(county):
+                    candidates[state + key_sep + variant].add(county)
+            for key, counties in candidates.items():
+                if key not in self.aliases and len(counties) == 1:
+                    self.aliases[key] = counties.pop()
+
+    @classmethod
+    def from_sources(cls, right, lefts=(), **kwargs):
+        """Build the index from the vocabularies of all sources
+
+        The canonical names come from the right table. The names of the left
+        tables are matched while building, so that resolving a name later is
+        a dictionary lookup.
+
+        Args:
+            right (pandas.DataFrame): parsed right table
+            lefts (list(pandas.DataFrame)): left tables with the
+                'sub_region_1' and 'sub_region_2' columns
+
+        Returns:
+            AliasIndex: index
+        """
+        index = right['sub_region_2'].notna()
+        alias_index = cls(right.loc[index, 'sub_region_1'],
+                          right.loc[index, 'sub_region_2'], **kwargs)
+        for left in lefts:
+            alias_index.learn(left['sub_region_1'], left['sub_region_2'])
+        return alias_index
+
+    def near_miss(self, key):
+        """Find the canonical name of a key by n-gram similarity
+
+        A candidate must have the same distinguishing tokens as the key, so
+        that a city is never matched to the county of the same name.
+
+        Args:
+            key (str): lookup key
+
+        Returns:
+            str: canonical name, or None if no unique match was found
+        """
+        state, _, county = key.partition(key_sep)
+        county = strip_suffix(county)
+        tokens = set(county.split()) & distinguishing_tokens
+        grams = ngrams(county)
+        counts = defaultdict(int)
+        for gram in grams:
+            for candidate in self.ngram_index.get(state + key_sep + gram, ()):
+                counts[candidate] += 1
+
+        best, best_score, tie = None, 0.0, False
+        for candidate, count in counts.items():
+            if set(strip_suffix(candidate).split()) & distinguishing_tokens != tokens:
+                continue
+            # Jaccard similarity of the two n-gram sets
+            score = count / float(len(grams) + len(ngrams(candidate)) - count)
+            if score > best_score:
+                best, best_score, tie = candidate, score, False
+            elif score == best_score:
+                tie = True
+
+        if best is None or tie or best_score < self.min_similarity:
+            return None
+        return best
+
+    def learn(self, sub_region_1, sub_region_2):
+        """Register the near-misses of the unknown keys of a vocabulary
+
+        The accepted near-misses are logged, so that a wrong match can be
+        spotted and fixed.
+
+        Args:
+            sub_region_1 (pandas.Series): state names
+            sub_region_2 (pandas.Series): county names
+        """
+        matched = []
+        for key in make_keys(sub_region_1, sub_region_2).dropna().unique():
+            if key in self.aliases:
+                continue
+            match = self.near_miss(key)
+            if match is not None:
+                self.aliases[key] = match
+                matched.append('{} -> {}'.format(key, match))
+        if matched:
+            logging.warning('{} region names were matched by similarity: {}'.format(
+                len(matched), ', '.join(sorted(matched))))
+
+    def resolve(self, sub_region_1, sub_region_2):
+        """Resolve county names to their canonical names
+
+        Keys that are not in the index are kept as they are and reported once
+        per run.
+
+        Args:
+            sub_region_1 (pandas.Series): state names
+            sub_region_2 (pandas.Series): county names
+
+        Returns:
+            pandas.Series: canonical county names
+        """
+        keys = make_keys(sub_region_1, sub_region_2)
+        resolved = keys.map(self.aliases)
+
+        unmatched = set(keys[resolved.isna() & keys.notna()].unique())
+        new_unmatched = sorted(unmatched - self.reported)
+        if new_unmatched:
+            self.reported.update(new_unmatched)
+            logging.warning('{} region names were not found in the alias index: {}'.format(
+                len(new_unmatched), ', '.join(new_unmatched)))
+
+        return resolved.fillna(normalize_series(sub_region_2))
+
+
+if __name__ == '__main__':
+    # behaviour check of the names that differ between the sources, run with
+    # python alias_index.py
+    right = pd.DataFrame([
+        ('maryland', 'baltimore'),
+        ('maryland', 'baltimore county'),
+        ('virginia', 'franklin'),
+        ('virginia', 'franklin county'),
+        ('missouri', 'st. louis'),
+        ('missouri', 'st. louis county'),
+        ('missouri', 'jackson county'),
+        ('virginia', 'fairfax county'),
+    ], columns=['sub_region_1', 'sub_region_2'])
+    right['sub_region_2'] = canonicalize_series(right['sub_region_2'], right['sub_region_1'])
+    alias_index = AliasIndex.from_sources(right)
+
+    expected = [
+        ('maryland', 'baltimore', 'baltimore county'),
+        ('maryland', 'baltimore city', 'baltimore'),
+        ('maryland', 'baltimore county', 'baltimore county'),
+        ('virginia', 'franklin', 'franklin county'),
+        ('virginia', 'franklin city', 'franklin'),
+        ('missouri', 'st. louis', 'st. louis county'),
+        ('missouri', 'st louis', 'st. louis county'),
+        ('missouri', 'st. louis city', 'st. louis'),
+        ('missouri', 'saint louis county', 'st. louis county'),
+        ('missouri', 'jackson', 'jackson'),
+        ('virginia', 'fairfax', 'fairfax'),
+    ]
+    left = pd.DataFrame(expected, columns=['sub_region_1', 'sub_region_2', 'expected'])
+    resolved = alias_index.resolve(left['sub_region_1'], left['sub_region_2'])
+    left['resolved'] = resolved
+    wrong = left['resolved'] != left['expected']
+    if wrong.any():
+        raise AssertionError('wrong aliases:\n{}'.format(left[wrong]))
+    print('{} aliases resolved as expected'.format(len(left)))
@@ -0,0 +1,188 @@
+import argparse
+import json
+import logging
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from integration_tasks import TestIntegration, run_integration, validate_input_date
+from result_writer import ResultWriter
+from utils import (alias_source_mtimes, build_alias_index, download_file,
+                   load_mobility_data_and_mtimes, mobility_source_mtimes, verify_data)
+
+
+class MobilityState(object):
+    """The right table, its alias index and the country codes, shared by all
+    the requests
+
+    The table is loaded once and reloaded in the background when the source
+    files change. The alias index is also rebuilt when the left tables it is
+    built from change. Until the new table is ready, the requests are served from
+    the old one. A request keeps the version it started with, so a reload
+    does not affect the requests that are running.
+
+    Args:
+        compact (bool): use the compact representation of the right table
+    """
+
+    def __init__(self, compact=False):
+        self.compact = compact
+        # guards the swap of the table
+        self.lock = threading.Lock()
+        # only one reload runs at a time
+        self.reload_lock = threading.Lock()
+        # modification times of the files of the right table and of the
+        # left tables of the alias index
+        self.mtimes = None
+        self.alias_mtimes = None
+        self.df2 = None
+        self.alias_index = None
+        # country code of every country name of the left tables, resolved
+        # once with pycountry
+        self.country_codes = {}
+
+    def stale(self, mtimes, alias_mtimes):
+        """Check whether the files changed since the table was loaded
+
+        Args:
+            mtimes (tuple(float)): modification times of the files of the
+                right table
+            alias_mtimes (tuple(float)): modification times of the left
+                tables of the alias index
+
+        Returns:
+            bool: True if the table or its alias index must be reloaded
+        """
+        return mtimes != mobility_source_mtimes() or alias_mtimes != alias_source_mtimes()
+
+    def reload(self):
+        """Reload the right table and its alias index if their files changed
+
+        The right table is only reloaded if its own files changed, otherwise
+        the alias index is rebuilt from the current table.
+        """
+        with self.reload_lock:
+            df2, mtimes = self.df2, self.mtimes
+            if df2 is not None and not self.stale(mtimes, self.alias_mtimes):
+                return
+            if df2 is None or mtimes != mobility_source_mtimes():
+                logging.info('load the right table... ')
+                df2, mtimes = load_mobility_data_and_mtimes(compact=self.compact)
+            # read before the build, so that a change during the build is
+            # picked up by the next reload
+            alias_mtimes = alias_source_mtimes()
+            alias_index = build_alias_index(df2)
+            with self.lock:
+                self.df2, self.alias_index = df2, alias_index
+                self.mtimes, self.alias_mtimes = mtimes, alias_mtimes
+
+    def get(self):
+        """Get the current right table, start a reload if the sources changed
+
+        Returns:
+            tuple(pandas.DataFrame, AliasIndex): right table and alias index
+        """
+        with self.lock:
+            df2, alias_index = self.df2, self.alias_index
+            mtimes, alias_mtimes = self.mtimes, self.alias_mtimes
+
+        if df2 is None:
+            # nothing to serve yet, wait for the first load
+            self.reload()
+            with self.lock:
+                return self.df2, self.alias_index
+
+        if self.stale(mtimes, alias_mtimes) and not self.reload_lock.locked():
+            threading.Thread(target=self.reload, daemon=True).start()
+        return df2, alias_index
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class IntegrationHandler(BaseHTTPRequestHandler):
+    """Serve GET /integrate?date=06-30-2020&tasks=test_a,test_b
+
+    The tasks parameter is optional, all the tasks run if it is missing.
+    """
+
+    def send_json(self, code, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/integrate':
+            self.send_json(404, {'error': '{} not found'.format(url.path)})
+            return
+
+        query = parse_qs(url.query)
+        all_tasks = unittest.TestLoader().getTestCaseNames(TestIntegration)
+        try:
+            input_date = query['date'][0]
+            validate_input_date(input_date)
+            task_names = query['tasks'][0].split(',') if 'tasks' in query else all_tasks
+            unknown = [name for name in task_names if name not in all_tasks]
+            if unknown:
+                raise ValueError('Unknown tasks: {}'.format(', '.join(unknown)))
+        except (KeyError, ValueError) as e:
+            self.send_json(400, {'error': str(e), 'tasks': list(all_tasks)})
+            return
+
+        df2, alias_index = self.server.state.get()
+        result = run_integration(input_date, task_names, df2, alias_index,
+                                 self.server.result_writer,
+                                 country_codes=self.server.state.country_codes)
+        self.send_json(200, result)
+
+    def log_message(self, format, *args):
+        logging.info(format % args)
+
+
+def serve(host='127.0.0.1', port=8642, compact=False, save=False):
+    """Start the integration service
+
+    Args:
+        host (str): address to listen on
+        port (int): port to listen on
+        compact (bool): use the compact representation of the right table
+        save (bool): save the integrated tables in target-datasets/
+    """
+    download_file()
+    verify_data()
+
+    server = ThreadingHTTPServer((host, port), IntegrationHandler)
+    server.state = MobilityState(compact=compact)
+    server.result_writer = ResultWriter('target-datasets') if save else None
+
+    # load the right table before the first request
+    server.state.get()
+    logging.warning('integration service listening on http://{}:{}/integrate'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server.result_writer is not None:
+            server.result_writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the integration tasks over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8642)
+    parser.add_argument('--compact', action='store_true',
+                        help='use the compact representation of the right table')
+    parser.add_argument('--save', action='store_true',
+                        help='save the integrated tables in target-datasets/')
+    args = parser.parse_args()
+
+    serve(args.host, args.port, compact=args.compact, save=args.save)
@@ -22,15 +22,64 @@ except ImportError:
     raise ImportError('gdown missing, please use pip to install it.')
 
 
+import io
 import os
 import pandas as pd
 import sys
 import unittest
 from datetime import datetime
-from utils import parse_coronavirus_data, parse_mobility_data, download_file, verify_data
+from utils import parse_coronavirus_data, load_mobility_data, build_alias_index, download_file, verify_data
+from utils import select_mobility_rows
+from result_writer import ResultWriter
+
+def validate_input_date(input_date):
+    """Check that the input date is valid and covered by the ground truth
+
+    Args:
+        input_date (str): report date, like 02-15-2020
+
+    Raises:
+        ValueError: if the date is not valid
+    """
+    try:
+        date = datetime.strptime(input_date, "%m-%d-%Y")
+    except ValueError:
+        error_msg = '{} is not a valid date format. Your input should be %m-%d-%Y, '\
+            'like: 02-15-2020'.format(input_date)
+        raise ValueError(error_msg)
+
+    if date < datetime(2020, 2, 15) or date > datetime(2020, 6, 30):
+        error_msg = 'The input date should fall in the dates range: '\
+            '[02-15-2020, 06-302020]'
+        raise ValueError(error_msg)
+
 
 class TestIntegration(unittest.TestCase):
 
+    # Use the compact representation of the right table
+    compact = False
+
+    # Print the memory used by the right table when it is loaded
+    memory_report = False
+
+    # Writer of the integrated tables, the tables are not saved if None
+    result_writer = None
+
+    # Pending write of every task, kept by run_integration to report the
+    # tables that could not be saved
+    write_futures = None
+
+    # Right table and its alias index, loaded by setUpClass if None
+    df2 = None
+    alias_index = None
+
+    # Country codes of the country names, memoized across the runs if set
+    country_codes = None
+
+    # Row ranges of the right table by level and date, only set if the table
+    # is sorted that way (see shared_mobility.py)
+    row_ranges = None
+
     @classmethod
     def setUpClass(cls):
         # Download data file
@@ -38,18 +87,33 @@ class TestIntegration(unittest.TestCase):
         # Verify the needed data exist
         verify_data()
 
-        # Parse the daily report data (left-table)
-        cls.df1=parse_coronavirus_data('source-datasets/'+cls.input_date+'.csv', cls.input_date)
-        
+        # The report date in the format of the right table
+        cls.report_date = datetime.strptime(cls.input_date, "%m-%d-%Y").strftime("%Y-%m-%d")
+
         # Parse the Google Mobility data (right-table)
         # Load the pre-parsed data to improve the performance
-        if os.path.isfile('right.csv'):
-            cls.df2 = pd.read_csv('right.csv', sep=',', header=0, encoding='utf-8', low_memory=False)
-        else:
-            cls.df2=parse_mobility_data('source-datasets/Global_Mobility_Report.csv')
-            # Save the parsed data to disk to improve performance at next 
-            # running time
-            cls.df2.to_csv('right.csv', encoding='utf-8', index=False)
+        if cls.df2 is None:
+            cls.df2 = load_mobility_data(compact=cls.compact, memory_report=cls.memory_report)
+
+        # Index of the county names of all the sources, used to resolve the
+        # county names of the left tables to the names of the right table
+        if cls.alias_index is None:
+            cls.alias_index = build_alias_index(cls.df2)
+
+        # Parse the daily report data (left-table)
+        cls.df1=parse_coronavirus_data('source-datasets/'+cls.input_date+'.csv', cls.input_date,
+                                       cls.alias_index, cls.country_codes)
+
+    def select_level(self, level, date):
+        # Select the rows of the right table reported at a level on a date
+        return select_mobility_rows(self.df2, level, date, self.row_ranges)
+
+    def save_result(self, level, task, date, joined):
+        # Save the integrated table if a result writer is set
+        if self.result_writer is not None:
+            future = self.result_writer.submit(level, task, date, joined)
+            if self.write_futures is not None:
+                self.write_futures[self._testMethodName] = future
 
     # Task 1
     # Data Integration at Country level with basic columns: 
@@ -61,8 +125,7 @@ class TestIntegration(unittest.TestCase):
             {'Confirmed':'sum', 'Deaths':'sum', 'Recovered':'sum'}) 
 
         # Select the data that is reported at the country level
-        index = ~self.df2[['sub_region_1', 'sub_region_2', 'metro_area']].notna().any(axis=1)
-        right = self.df2[index]
+        right = self.select_level('country', self.report_date)
 
         # Perform inner join
         joined = left.merge(right, how='inner', on=['country_region_code', 'date'])
@@ -72,7 +135,10 @@ class TestIntegration(unittest.TestCase):
         joined_exp = pd.read_csv(joined_exp_path, encoding='utf-8')
 
         # Compare the results
-        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False)
+        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False, check_categorical=False)
+
+        # Save the result
+        self.save_result('country', 'country', self.input_date, joined)
 
     # Task 2
     # Data Integration at Country level with extra columns: 
@@ -93,8 +159,7 @@ class TestIntegration(unittest.TestCase):
             })
         
         # Select the data that is reported at the country level
-        index = ~self.df2[['sub_region_1', 'sub_region_2', 'metro_area']].notna().any(axis=1)
-        right = self.df2[index]
+        right = self.select_level('country', self.report_date)
 
         # Perform inner join
         joined = left.merge(right, how='inner', on=['country_region_code', 'date'])
@@ -105,7 +170,10 @@ class TestIntegration(unittest.TestCase):
         joined_exp = pd.read_csv(joined_exp_path, encoding='utf-8')
 
         # Compare the results
-        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False)
+        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False, check_categorical=False)
+
+        # Save the result
+        self.save_result('country', 'country-with-extra-columns', self.input_date, joined)
     
     # Task 3
     # Data Integration at State level with basic columns: 
@@ -117,8 +185,7 @@ class TestIntegration(unittest.TestCase):
             {'Confirmed':'sum', 'Deaths':'sum', 'Recovered':'sum'})
 
         # Select the data that is reported at the state level
-        index = ~self.df2[['sub_region_2']].notna().any(axis=1)
-        right = self.df2[index]
+        right = self.select_level('state', self.report_date)
 
         # Perform inner join
         joined = left.merge(right, how='inner', 
@@ -129,7 +196,10 @@ class TestIntegration(unittest.TestCase):
         joined_exp = pd.read_csv(joined_exp_path, encoding='utf-8')
 
         # Compare the results
-        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False)
+        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False, check_categorical=False)
+
+        # Save the result
+        self.save_result('state', 'state', self.input_date, joined)
 
     # Task 4
     # Data Integration at State level with extra columns: 
@@ -150,8 +220,7 @@ class TestIntegration(unittest.TestCase):
             })
 
         # Select the data that is reported at the state level
-        index = ~self.df2[['sub_region_2']].notna().any(axis=1)
-        right = self.df2[index]
+        right = self.select_level('state', self.report_date)
 
         # Perform inner join
         joined = left.merge(right, how='inner', 
@@ -163,7 +232,10 @@ class TestIntegration(unittest.TestCase):
         joined_exp = pd.read_csv(joined_exp_path, encoding='utf-8')
 
         # Compare the results
-        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False)
+        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False, check_categorical=False)
+
+        # Save the result
+        self.save_result('state', 'state-with-extra-columns', self.input_date, joined)
 
     # Task 5
     # Data Integration at County level with basic columns: 
@@ -176,8 +248,7 @@ class TestIntegration(unittest.TestCase):
             {'Confirmed':'sum', 'Deaths':'sum', 'Recovered':'sum'})
         
         # Select the data that is reported at the county level
-        index = self.df2[['sub_region_2']].notna().any(axis=1)
-        right = self.df2[index]
+        right = self.select_level('county', self.report_date)
         
         # Perform inner join
         joined = left.merge(right, how='inner', on=['country_region_code', 'sub_region_1', 'sub_region_2', 'date'])
@@ -186,7 +257,10 @@ class TestIntegration(unittest.TestCase):
         joined_exp = pd.read_csv(joined_exp_path, encoding='utf-8')
 
         # Compare the results
-        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False)
+        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False, check_categorical=False)
+
+        # Save the result
+        self.save_result('county', 'county', self.input_date, joined)
 
     # Task 6
     # Data Integration at County level with extra columns: 
@@ -206,8 +280,7 @@ class TestIntegration(unittest.TestCase):
             })
 
         # Select the data that is reported at the county level
-        index = self.df2[['sub_region_2']].notna().any(axis=1)
-        right = self.df2[index]
+        right = self.select_level('county', self.report_date)
 
         # Perform inner join
         joined = left.merge(right, how='inner', on=['country_region_code', 'sub_region_1', 'sub_region_2', 'date'])
@@ -217,7 +290,10 @@ class TestIntegration(unittest.TestCase):
         joined_exp = pd.read_csv(joined_exp_path, encoding='utf-8')
 
         # Compare the results
-        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False)
+        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False, check_categorical=False)
+
+        # Save the result
+        self.save_result('county', 'county-with-extra-columns', self.input_date, joined)
 
     # Task 7
     # Replace left table (JHU daily report) by NYTimes COVID Report
@@ -231,16 +307,14 @@ class TestIntegration(unittest.TestCase):
 
         df1 = df1[df1['date'] == '2020-06-30']
         df1['sub_region_1'] = df1['sub_region_1'].str.lower()
-        df1['sub_region_2'] = df1['sub_region_2'].str.lower()
-        df1['sub_region_2'] = df1['sub_region_2'].str.strip()
+        df1['sub_region_2'] = self.alias_index.resolve(df1['sub_region_1'], df1['sub_region_2'])
         
         left = df1.groupby(['sub_region_1','sub_region_2', 'date']).agg(
             {
                 "fips":"sum","cases":"sum","deaths":"sum"
             })
         # Select the data that is reported at the county level
-        index=  self.df2[['sub_region_2']].notna().any(axis=1)
-        right = self.df2[index]
+        right = self.select_level('county', '2020-06-30')
 
         # FIXME if broken
         joined = left.merge(right, how='inner', 
@@ -256,7 +330,10 @@ class TestIntegration(unittest.TestCase):
         joined_exp = pd.read_csv(joined_exp_path, encoding='utf-8')
 
         # Compare the results
-        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False)
+        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False, check_categorical=False)
+
+        # Save the result
+        self.save_result('county', 'replace-by-nyt', '06-30-2020', joined)
     
     # Task 8
     # Replace left table (JHU daily report) by JHU COVID TimeSeries Report
@@ -269,8 +346,7 @@ class TestIntegration(unittest.TestCase):
         # left =
         
         # Select the data that is reported at the county level
-        index=  self.df2[['sub_region_2']].notna().any(axis=1)
-        right = self.df2[index]
+        right = self.select_level('county', '2020-06-30')
 
         # FIXME if broken
         joined = right
@@ -280,30 +356,89 @@ class TestIntegration(unittest.TestCase):
         joined_exp = pd.read_csv(joined_exp_path, encoding='utf-8')
 
         # Compare the results
-        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False)
+        pd.testing.assert_frame_equal(joined, joined_exp, check_dtype=False, check_categorical=False)
+
+        # Save the result
+        self.save_result('county', 'replace-by-jhu-timeseries', '06-30-2020', joined)
+
+def run_integration(input_date, task_names, df2, alias_index, result_writer=None,
+                    row_ranges=None, country_codes=None):
+    """Run the integration tasks of a date on a loaded right table
+
+    Args:
+        input_date (str): report date, like 06-30-2020
+        task_names (list(str)): names of the tasks, like
+            test_country_level_with_basic_columns
+        df2 (pandas.DataFrame): right table
+        alias_index (AliasIndex): alias index of the right table
+        result_writer (ResultWriter): writer of the integrated tables
+        row_ranges (dict): row ranges of the right table by level and date
+        country_codes (dict): country codes memoized across the runs
+
+    Returns:
+        dict: status of every task ('ok', 'fail' or 'error') and the messages
+            of the tasks that did not succeed. A task whose table could not
+            be saved is an error
+    """
+    # every run gets its own copy of the test class, so that concurrent
+    # runs do not share the left table
+    test_class = type('TestIntegration', (TestIntegration,), {
+        'input_date': input_date,
+        'df2': df2,
+        'alias_index': alias_index,
+        'result_writer': result_writer,
+        'row_ranges': row_ranges,
+        'country_codes': country_codes,
+        'write_futures': {},
+    })
+    suite = unittest.TestSuite()
+    for task_name in task_names:
+        suite.addTest(test_class(task_name))
+
+    result = unittest.TextTestRunner(stream=io.StringIO()).run(suite)
+
+    status = {task_name: 'ok' for task_name in task_names}
+    messages = {}
+    for label, problems in [('fail', result.failures), ('error', result.errors)]:
+        for test, traceback in problems:
+            # an error of setUpClass is not reported per task
+            task_name = getattr(test, '_testMethodName', None)
+            if task_name in status:
+                status[task_name] = label
+                messages[task_name] = traceback
+            else:
+                status = {task_name: label for task_name in task_names}
+                messages = {task_name: traceback for task_name in task_names}
+
+    # the tables are written in the background, a task whose table could not
+    # be saved did not succeed
+    if result_writer is not None:
+        for task_name, error in result_writer.wait(test_class.write_futures).items():
+            status[task_name] = 'error'
+            messages[task_name] = 'failed to save the integrated table: {}'.format(error)
+    return {'date': input_date, 'status': status, 'messages': messages}
+
 
 if __name__ == '__main__':
     # logging.getLogger().setLevel(logging.INFO)
 
     # Argument validation
+    # Optional flags:
+    #   --compact: use the compact representation of the right table
+    #   --save: save the integrated tables in target-datasets/
+    #   --memory-report: print the memory used by the right table
     try:
         input_date = sys.argv[1]
     except IndexError:
         raise ValueError('You need to specify the date as an input argument, like 02-15-2020')
-    try:
-        date = datetime.strptime(input_date, "%m-%d-%Y")
-    except ValueError:
-        error_msg = '{} is not a valid date format. Your input should be %m-%d-%Y, '\
-            'like: 02-15-2020'.format(input_date)
-        raise ValueError(error_msg)
-
-    if date < datetime(2020, 2, 15) or date > datetime(2020, 6, 30):
-        error_msg = 'The input date should fall in the dates range: '\
-            '[02-15-2020, 06-302020]'
-        raise ValueError(error_msg)
+    validate_input_date(input_date)
 
     # Pass the input_date to the test class
     TestIntegration.input_date = input_date
+    TestIntegration.compact = '--compact' in sys.argv[2:]
+    TestIntegration.memory_report = '--memory-report' in sys.argv[2:]
+    if '--save' in sys.argv[2:]:
+        TestIntegration.result_writer = ResultWriter('target-datasets')
 
     # Run the integration tasks
     test_loader = unittest.TestLoader()
@@ -312,4 +447,8 @@ if __name__ == '__main__':
     for test_name in test_names:
         suite.addTest(TestIntegration(test_name))
 
-    result = unittest.TextTestRunner(verbosity=2).run(suite)
\ No newline at end of file
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+
+    # Wait for the integrated tables to be saved
+    if TestIntegration.result_writer is not None:
+        TestIntegration.result_writer.close()
@@ -0,0 +1,223 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# suffix of the files that are being written
+tmp_suffix = '.tmp'
+
+# a file that is being written is tagged with <host>@<pid>@<id>, a host
+# name cannot contain '@'
+tag_sep = '@'
+
+# age after which the file of a process of another host is considered stale
+stale_age = 24 * 3600
+
+
+def tmp_name(name):
+    """Name of the temporary file of a partition written by this process
+
+    Args:
+        name (str): file name of the partition
+
+    Returns:
+        str: temporary file name
+    """
+    return '.{}{}'.format(tag_sep.join([socket.gethostname(), str(os.getpid()),
+                                        uuid.uuid4().hex, name]), tmp_suffix)
+
+
+def process_alive(pid):
+    """Check whether a process of this host is running
+
+    Args:
+        pid (int): process id
+
+    Returns:
+        bool: True if the process is running
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def is_stale(path):
+    """Check whether a temporary file was left behind by a crashed process
+
+    A file of this host is stale when its process is no longer running. The
+    processes of other hosts cannot be checked, so their files are stale
+    after stale_age seconds.
+
+    Args:
+        path (str): path of the temporary file
+
+    Returns:
+        bool: True if the file can be removed
+    """
+    tag = os.path.basename(path)[1:].split(tag_sep)
+    if len(tag) == 4 and tag[0] == socket.gethostname() and tag[1].isdigit() \
+            and os.name == 'posix':
+        return not process_alive(int(tag[1]))
+    return time.time() - os.path.getmtime(path) > stale_age
+
+
+def remove_partial_files(root):
+    """Remove the partially written files left in a folder by crashed runs
+
+    The files that are still being written by other processes are kept.
+
+    Args:
+        root (str): output folder
+    """
+    if not os.path.isdir(root):
+        return
+    for folder, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(folder, name)
+            if not name.endswith(tmp_suffix):
+                continue
+            try:
+                if is_stale(path):
+                    logging.warning('remove partially written file {}'.format(name))
+                    os.remove(path)
+            except FileNotFoundError:
+                # renamed by its writer in the meantime
+                pass
+
+
+def fsync_path(path):
+    """Flush a file or a folder to the disk
+
+    Args:
+        path (str): path of the file or folder
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ResultWriter(object):
+    """Write the integrated tables in the background
+
+    Every table is written to <root>/<level>/<task>/<date>.csv.gz by a pool
+    of writer threads, so that the integration does not wait for the disk.
+    A table is first written to a temporary file in the same folder and then
+    renamed, which makes a partition either complete or missing. Temporary
+    files left behind by crashed processes are removed when the writer
+    starts, the files of the running processes are kept.
+
+    Args:
+        root (str): output folder
+        max_workers (int): number of writer threads
+        cleanup (bool): remove the partially written files of crashed runs
+    """
+
+    def __init__(self, root='target-datasets', max_workers=4, cleanup=True):
+        self.root = root
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+        self.lock = threading.Lock()
+        if cleanup:
+            self.cleanup()
+
+    def partition_path(self, level, task, date):
+        """Path of a partition
+
+        Args:
+            level (str): integration level, like 'country'
+            task (str): task name, like 'country-with-extra-columns'
+            date (str): report date, like 06-30-2020
+
+        Returns:
+            str: path
+        """
+        return os.path.join(self.root, level, task, date + '.csv.gz')
+
+    def cleanup(self):
+        """Remove the partially written files of crashed runs"""
+        remove_partial_files(self.root)
+
+    def submit(self, level, task, date, df):
+        """Schedule a table to be written
+
+        The dataframe must not be modified after it was submitted.
+
+        Args:
+            level (str): integration level, like 'country'
+            task (str): task name, like 'country-with-extra-columns'
+            date (str): report date, like 06-30-2020
+            df (pandas.DataFrame): integrated table
+
+        Returns:
+            concurrent.futures.Future: pending write, see wait
+        """
+        path = self.partition_path(level, task, date)
+        future = self.executor.submit(self._write, path, df)
+        with self.lock:
+            # only keep the pending writes and the failed ones
+            self.futures = [f for f in self.futures
+                            if not f.done() or f.exception() is not None]
+            self.futures.append(future)
+        return future
+
+    def _write(self, path, df):
+        folder, name = os.path.split(path)
+        os.makedirs(folder, exist_ok=True)
+        tmp_path = os.path.join(folder, tmp_name(name))
+        try:
+            df.to_csv(tmp_path, encoding='utf-8', index=False, compression='gzip')
+            # the content must be on the disk before the rename, so that an
+            # OS crash does not leave an empty partition behind
+            fsync_path(tmp_path)
+            os.replace(tmp_path, path)
+            if os.name == 'posix':
+                fsync_path(folder)
+        except BaseException:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+        logging.info('{} saved'.format(path))
+
+    def wait(self, futures):
+        """Wait for some of the tables to be written
+
+        The failed writes are returned to the caller, and are not reported
+        again by close.
+
+        Args:
+            futures (dict): futures returned by submit, by any key
+
+        Returns:
+            dict: exception of every failed write, by key
+        """
+        errors = {}
+        for key, future in futures.items():
+            if future.exception() is not None:
+                errors[key] = future.exception()
+        with self.lock:
+            self.futures = [f for f in self.futures if f not in futures.values()]
+        return errors
+
+    def close(self):
+        """Wait for all the tables to be written
+
+        Raises:
+            IOError: if a table could not be written
+        """
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            errors = [f.exception() for f in self.futures if f.exception() is not None]
+            self.futures = []
+        if errors:
+            for error in errors:
+                logging.error('failed to save an integrated table: {}'.format(error))
+            raise IOError('{} integrated tables could not be saved'.format(len(errors)))
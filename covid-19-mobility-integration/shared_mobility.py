@@ -0,0 +1,340 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import shutil
+import sys
+import unittest
+import uuid
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from integration_tasks import TestIntegration, run_integration, validate_input_date
+from result_writer import ResultWriter, remove_partial_files
+from utils import (build_alias_index, compact_mobility_frame, download_file,
+                   load_mobility_data_and_mtimes, mobility_row_group, mobility_row_groups,
+                   mobility_source_mtimes, verify_data)
+
+# link to the folder of the current version of the memory-mapped right table
+default_table_path = 'mobility-table'
+
+
+def table_versions(path):
+    """Folders of the published versions of a table, oldest first
+
+    Args:
+        path (str): link to the current version of the table
+
+    Returns:
+        list(str): folders of the versions
+    """
+    folder, name = os.path.split(os.path.abspath(path))
+    versions = [os.path.join(folder, entry) for entry in os.listdir(folder)
+                if entry.startswith(name + '.v') and os.path.isdir(os.path.join(folder, entry))]
+    return sorted(versions, key=os.path.getmtime)
+
+
+def publish_mobility_table(df, path=default_table_path, source_mtimes=None):
+    """Write the right table as memory-mappable column files
+
+    The rows are sorted so that the rows of a level on a date are a slice of
+    the table: the county rows first, then the other rows, by date and by
+    group (see mobility_row_groups). The row range of every group and date is
+    stored with the table.
+
+    Categorical columns are stored as their integer codes, one file per
+    column. Consecutive numeric columns of the same dtype are stored together
+    as one 2-D array, which becomes a single pandas block when attached.
+
+    Every version is written to its own folder. The path is a symbolic link
+    to the current version, switched by a single rename, so that a process
+    always attaches a complete version.
+
+    Args:
+        df (pandas.DataFrame): right table
+        path (str): link to the current version of the table
+        source_mtimes (tuple(float)): modification times of the source files
+            the table was loaded from
+    """
+    df = compact_mobility_frame(df)
+
+    # the state and country rows of a date are adjacent, the original order
+    # is kept within a group and a date
+    groups = mobility_row_group(df)
+    dates = df['date'].cat.codes.values
+    order = np.lexsort((groups, dates, groups != 0))
+    df = df.take(order)
+    df.reset_index(drop=True, inplace=True)
+    groups, dates = groups[order], dates[order]
+
+    row_ranges = {group: {} for group in mobility_row_groups}
+    changes = (groups[1:] != groups[:-1]) | (dates[1:] != dates[:-1])
+    starts = np.flatnonzero(np.r_[True, changes])
+    stops = np.r_[starts[1:], len(df)]
+    for start, stop in zip(starts, stops):
+        # rows without a date are never selected
+        if dates[start] >= 0:
+            date = df['date'].cat.categories[dates[start]]
+            row_ranges[mobility_row_groups[groups[start]]][date] = [int(start), int(stop)]
+
+    pieces = []
+    for column in df.columns:
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype) or \
+                not pd.api.types.is_numeric_dtype(series.dtype):
+            pieces.append({'kind': 'category', 'columns': [column]})
+        elif pieces and pieces[-1]['kind'] == 'block' and pieces[-1]['dtype'] == series.dtype.name:
+            pieces[-1]['columns'].append(column)
+        else:
+            pieces.append({'kind': 'block', 'columns': [column], 'dtype': series.dtype.name})
+
+    # two blocks of the same dtype are merged (copied) by pandas in every
+    # process, which defeats the memory mapping
+    block_dtypes = [piece['dtype'] for piece in pieces if piece['kind'] == 'block']
+    if len(block_dtypes) != len(set(block_dtypes)):
+        logging.warning('the numeric columns of the same dtype are not consecutive, '
+                        'the attached table will be copied in every process')
+
+    version_path = '{}.v{}'.format(path, uuid.uuid4().hex)
+    os.makedirs(version_path)
+    try:
+        for i, piece in enumerate(pieces):
+            piece['file'] = '{}.npy'.format(i)
+            if piece['kind'] == 'category':
+                series = df[piece['columns'][0]].astype('category')
+                piece['categories'] = series.cat.categories.tolist()
+                values = series.cat.codes.values
+            else:
+                # one row per column, so that the block is not transposed
+                values = np.ascontiguousarray(df[piece['columns']].values.T)
+            np.save(os.path.join(version_path, piece['file']), values)
+
+        meta = {
+            'n_rows': len(df),
+            'source_mtimes': source_mtimes,
+            'pieces': pieces,
+            'row_ranges': row_ranges,
+        }
+        with open(os.path.join(version_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+    except BaseException:
+        shutil.rmtree(version_path)
+        raise
+
+    # a folder published by a previous release of this module
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    # the link is relative, so that the tables can be moved with their folder
+    link_path = '{}.{}.link'.format(path, uuid.uuid4().hex)
+    os.symlink(os.path.basename(version_path), link_path)
+    os.replace(link_path, path)
+
+    # the previous version is kept for the processes that are attaching it,
+    # the processes that attached an older one keep their mapping
+    current_path = os.path.realpath(path)
+    for old_path in table_versions(path)[:-2]:
+        if old_path != current_path:
+            shutil.rmtree(old_path, ignore_errors=True)
+
+
+def read_table_meta(path=default_table_path):
+    """Read the description of a published right table
+
+    Args:
+        path (str): folder of the table
+
+    Returns:
+        dict: description, or None if the table was not published
+    """
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def copy_on_write():
+    """Check whether pandas uses Copy-on-Write
+
+    With Copy-on-Write, pandas.concat does not copy the frames and its copy
+    keyword is deprecated. Without it, copy=False is needed to keep the
+    memory maps.
+
+    Returns:
+        bool: True if Copy-on-Write is active
+    """
+    major = int(pd.__version__.split('.')[0])
+    if major >= 3:
+        return True
+    return major == 2 and pd.get_option('mode.copy_on_write') is True
+
+
+def attach_mobility_table(path=default_table_path):
+    """Attach a published right table without copying its content
+
+    The numeric blocks and the category codes are read-only memory maps
+    shared by all the processes through the page cache.
+
+    Args:
+        path (str): link to the current version of the table
+
+    Returns:
+        tuple(pandas.DataFrame, dict): read-only right table and the row range
+            of every group and date
+    """
+    # the link is resolved once, a new version may be published meanwhile
+    path = os.path.realpath(path)
+    meta = read_table_meta(path)
+    if meta is None:
+        raise FileNotFoundError('{} is not a published right table.'.format(path))
+
+    frames = []
+    for piece in meta['pieces']:
+        values = np.load(os.path.join(path, piece['file']), mmap_mode='r')
+        if piece['kind'] == 'category':
+            dtype = pd.CategoricalDtype(piece['categories'])
+            frames.append(pd.DataFrame(
+                {piece['columns'][0]: pd.Categorical.from_codes(values, dtype=dtype)},
+                copy=False))
+        else:
+            frames.append(pd.DataFrame(values.T, columns=piece['columns'], copy=False))
+    concat_kwargs = {} if copy_on_write() else {'copy': False}
+    return pd.concat(frames, axis=1, **concat_kwargs), meta['row_ranges']
+
+
+def publish_if_stale(path=default_table_path):
+    """Publish the right table if it is missing or its sources changed
+
+    Args:
+        path (str): link to the current version of the table
+    """
+    meta = read_table_meta(path)
+    # the tables published without row ranges are published again
+    if meta is not None and 'row_ranges' in meta and \
+            meta['source_mtimes'] == list(mobility_source_mtimes()):
+        logging.info('{} is up to date.'.format(path))
+        return
+
+    logging.info('publish the right table to {}... '.format(path))
+    df2, mtimes = load_mobility_data_and_mtimes()
+    publish_mobility_table(df2, path, mtimes)
+
+
+# state of a worker process
+worker_state = {}
+
+
+def attach_worker(path, save):
+    """Initialize a worker process with the published right table
+
+    The result writer of the worker writes the tables of all its dates. The
+    writes of a date are waited for by integrate_date, and the writer is
+    only shut down when the worker exits.
+
+    Args:
+        path (str): link to the current version of the table
+        save (bool): save the integrated tables in target-datasets/
+    """
+    df2, row_ranges = attach_mobility_table(path)
+    worker_state['df2'] = df2
+    worker_state['row_ranges'] = row_ranges
+    worker_state['alias_index'] = build_alias_index(df2)
+    worker_state['country_codes'] = {}
+    worker_state['result_writer'] = None
+    if save:
+        # the other workers write to the same folder, so the partially
+        # written files are removed once by the main process
+        result_writer = ResultWriter('target-datasets', cleanup=False)
+        multiprocessing.util.Finalize(result_writer, result_writer.close, exitpriority=10)
+        worker_state['result_writer'] = result_writer
+
+
+def integrate_date(input_date, task_names):
+    """Run the integration tasks of a date in a worker process
+
+    The tables of the date are written before it returns. A table that could
+    not be saved makes its task an error, so that the main process reports
+    it, rather than an exception at the exit of the worker that the pool
+    would ignore.
+
+    Args:
+        input_date (str): report date, like 06-30-2020
+        task_names (list(str)): names of the tasks
+
+    Returns:
+        dict: result of run_integration
+    """
+    return run_integration(input_date, task_names, worker_state['df2'],
+                           worker_state['alias_index'], worker_state['result_writer'],
+                           worker_state['row_ranges'], worker_state['country_codes'])
+
+
+def integrate_dates(dates, task_names, workers, path=default_table_path, save=False):
+    """Run the integration tasks of many dates in parallel
+
+    The right table is published once, every worker process attaches to it.
+
+    Args:
+        dates (list(str)): report dates, like 06-30-2020
+        task_names (list(str)): names of the tasks
+        workers (int): number of worker processes
+        path (str): link to the current version of the table
+        save (bool): save the integrated tables in target-datasets/
+
+    Returns:
+        list(dict): results of run_integration, sorted by date
+    """
+    download_file()
+    verify_data()
+    publish_if_stale(path)
+    if save:
+        remove_partial_files('target-datasets')
+
+    pool = multiprocessing.Pool(workers, initializer=attach_worker, initargs=(path, save))
+    try:
+        results = pool.map(partial(integrate_date, task_names=task_names), dates)
+    finally:
+        # the writes were waited for by integrate_date, the workers only
+        # shut down their writer when they exit
+        pool.close()
+        pool.join()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run the integration tasks of a range of dates on all cores.')
+    parser.add_argument('start_date', help='first date, like 02-15-2020')
+    parser.add_argument('end_date', help='last date, like 06-30-2020')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--tasks', help='comma separated names of the tasks, all by default')
+    parser.add_argument('--save', action='store_true',
+                        help='save the integrated tables in target-datasets/')
+    args = parser.parse_args()
+
+    validate_input_date(args.start_date)
+    validate_input_date(args.end_date)
+    dates = [date.strftime('%m-%d-%Y') for date in pd.date_range(
+        pd.to_datetime(args.start_date, format='%m-%d-%Y'),
+        pd.to_datetime(args.end_date, format='%m-%d-%Y'))]
+
+    all_tasks = unittest.TestLoader().getTestCaseNames(TestIntegration)
+    task_names = args.tasks.split(',') if args.tasks else all_tasks
+    unknown = [name for name in task_names if name not in all_tasks]
+    if unknown:
+        raise ValueError('Unknown tasks: {}'.format(', '.join(unknown)))
+
+    results = integrate_dates(dates, task_names, args.workers, save=args.save)
+
+    failed = 0
+    for result in results:
+        for task_name in task_names:
+            status = result['status'][task_name]
+            print('{} {} ... {}'.format(result['date'], task_name, status))
+            failed += status != 'ok'
+    print('{} of {} tasks did not succeed'.format(failed, len(dates) * len(task_names)))
+    sys.exit(1 if failed else 0)
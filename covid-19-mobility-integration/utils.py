@@ -1,10 +1,13 @@
 from logging import error
 import pandas as pd
 import datetime
+import glob
 import os
 import numpy as np
 import pycountry
 import logging
+import sys
+from alias_index import AliasIndex, canonicalize_series
 
 # a list of countries
 list_regions = [c.name.lower() for c in list(pycountry.countries)]
@@ -63,12 +66,40 @@ def country_alpha2_from_name(df, list_regions):
         return country_region_code
 
 
-def parse_coronavirus_data(data_path, input_date):
+def country_alpha2_from_names(df, country_codes):
+    """Vectorized version of country_alpha2_from_name
+
+    The code of every distinct (country_region_code, country_region) pair
+    is resolved once and memoized in country_codes, so that a resident
+    process does not search pycountry again for every report.
+
+    Args:
+        df (pandas.DataFrame): input, with the 'country_region_code' and
+            'country_region' columns
+        country_codes (dict): memoized codes, updated in place
+
+    Returns:
+        list(str): country_region_code of every row
+    """
+    keys = [(None if pd.isna(code) else code, name) for code, name in
+            zip(df['country_region_code'], df['country_region'])]
+    for key in set(keys) - set(country_codes):
+        row = pd.Series({'country_region_code': np.nan if key[0] is None else key[0],
+                         'country_region': key[1]})
+        country_codes[key] = country_alpha2_from_name(row, list_regions)
+    return [country_codes[key] for key in keys]
+
+
+def parse_coronavirus_data(data_path, input_date, alias_index=None, country_codes=None):
     """ Parse the JHU daily report data (left table)
 
     Args:
         data_path (str): path to the data file
         input_date (str): report date
+        alias_index (AliasIndex): index used to resolve the county names to
+            the names of the right table, the names are kept as is if None
+        country_codes (dict): country codes memoized across the reports,
+            see country_alpha2_from_names
     
     Returns:
         pandas.DataFrame: parsed df
@@ -198,7 +229,8 @@ def parse_coronavirus_data(data_path, input_date):
     # create country_region_code column if it does not exist
     if 'country_region_code' not in df.columns:
         df['country_region_code'] = np.nan
-    df['country_region_code'] = df.apply(country_alpha2_from_name, list_regions=list_regions, axis=1)
+    df['country_region_code'] = country_alpha2_from_names(
+        df, {} if country_codes is None else country_codes)
 
     # 5. to lowercase
     logging.info('convert string to lower case... ')
@@ -209,6 +241,11 @@ def parse_coronavirus_data(data_path, input_date):
     df['sub_region_2']=df['sub_region_2'].str.lower()
     df['country_region_code'] = df['country_region_code'].str.lower()
 
+    # 6. resolve the county names to the names of the right table
+    if alias_index is not None:
+        logging.info('resolve county names... ')
+        df['sub_region_2'] = alias_index.resolve(df['sub_region_1'], df['sub_region_2'])
+
     return df
 
 def parse_mobility_data(data_path):
@@ -237,12 +274,9 @@ def parse_mobility_data(data_path):
     to_fix_df = df[to_fix_index]
     df.loc[to_fix_index, 'country_region_code'] = to_fix_df.apply(country_alpha2_from_name, list_regions=list_regions, axis=1)
 
-    # 3. remove 'county', 'city' string from sub_region_2
-    remove_dict = {
-        'county': '',
-        'city': ''
-    }
-    df['sub_region_2'] = df['sub_region_2'].replace(remove_dict, regex=True)
+    # 3. remove the trailing administrative suffix ('county', 'parish', etc.)
+    # from sub_region_2, unless two regions of a state would get the same name
+    df['sub_region_2'] = canonicalize_series(df['sub_region_2'], df['sub_region_1'])
 
     # 4. remove leading and trailing blank
     logging.info('remove leading and trailing blank... (another table)')
@@ -254,6 +288,324 @@ def parse_mobility_data(data_path):
  
     return df
 
+# string columns of the right table that are repeated on many rows
+mobility_category_columns = [
+    'country_region_code',
+    'country_region',
+    'sub_region_1',
+    'sub_region_2',
+    'metro_area',
+    'iso_3166_2_code',
+    'date',
+]
+
+# metric columns of the right table, whose values are small integers or NaN
+mobility_metric_columns = [
+    'retail_and_recreation_percent_change_from_baseline',
+    'grocery_and_pharmacy_percent_change_from_baseline',
+    'parks_percent_change_from_baseline',
+    'transit_stations_percent_change_from_baseline',
+    'workplaces_percent_change_from_baseline',
+    'residential_percent_change_from_baseline',
+]
+
+
+# version of the output of parse_mobility_data. Increase it when the parsing
+# changes, so that the right tables cached by the previous versions are not
+# used anymore
+mobility_parser_version = 2
+
+# files of the right table: the source file and the cache of the parsed data
+mobility_source_files = [
+    'source-datasets/Global_Mobility_Report.csv',
+    'right.v{}.csv'.format(mobility_parser_version),
+]
+
+
+# files of the left tables whose county names are registered in the alias
+# index: the NYTimes report and the JHU time series report
+alias_source_files = [
+    'source-datasets/us-counties-nyt.csv',
+    'source-datasets/time_series_covid19_confirmed_US.csv',
+]
+
+
+# groups of rows of the right table, each level of the integration tasks
+# selects one or more groups
+mobility_row_groups = ['county', 'state', 'country']
+mobility_levels = {
+    'country': ['country'],
+    # the rows without sub_region_2, including the country level rows
+    'state': ['state', 'country'],
+    'county': ['county'],
+}
+
+
+def mobility_row_group(df):
+    """Group of every row of the right table
+
+    Args:
+        df (pandas.DataFrame): right table
+
+    Returns:
+        numpy.ndarray: index of the group in mobility_row_groups
+    """
+    county = df['sub_region_2'].notna().values
+    country = ~df[['sub_region_1', 'sub_region_2', 'metro_area']].notna().any(axis=1).values
+    return np.where(county, 0, np.where(country, 2, 1))
+
+
+def select_mobility_rows(df, level, date, row_ranges=None):
+    """Select the rows of the right table reported at a level on a date
+
+    Args:
+        df (pandas.DataFrame): right table
+        level (str): 'country', 'state' or 'county'
+        date (str): date, like 2020-06-30
+        row_ranges (dict): row range of every group and date, like
+            {'county': {'2020-06-30': [0, 100]}}, given if the table is sorted
+            by group and date. The rows are then sliced without a copy.
+
+    Returns:
+        pandas.DataFrame: selected rows
+    """
+    if row_ranges is None:
+        groups = mobility_row_group(df)
+        index = np.isin(groups, [mobility_row_groups.index(g) for g in mobility_levels[level]])
+        return df[index & (df['date'] == date).values]
+
+    # the adjacent ranges are merged, so that a level is usually one slice
+    ranges = []
+    for start, stop in sorted(row_ranges[group][date] for group in mobility_levels[level]
+                              if date in row_ranges[group]):
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = stop
+        else:
+            ranges.append([start, stop])
+    if not ranges:
+        return df.iloc[0:0]
+    if len(ranges) == 1:
+        return df.iloc[ranges[0][0]:ranges[0][1]]
+    return pd.concat([df.iloc[start:stop] for start, stop in ranges])
+
+
+def memory_usage_mb(df):
+    """Memory used by a dataframe, including the content of strings
+
+    Args:
+        df (pandas.DataFrame): input
+
+    Returns:
+        float: memory usage in MB
+    """
+    return df.memory_usage(deep=True).sum() / 1024.0 ** 2
+
+
+def compact_mobility_dtypes():
+    """dtypes of the compact representation of the right table
+
+    Returns:
+        dict: dtype of every column, to be passed to pandas.read_csv
+    """
+    dtypes = {column: 'category' for column in mobility_category_columns}
+    dtypes.update({column: 'float32' for column in mobility_metric_columns})
+    return dtypes
+
+
+def parsed_memory_usage_mb(df):
+    """Memory used by the right table as parse_mobility_data returns it
+
+    The usage is estimated from the compact representation when the table
+    was read in it: every value of a categorical column counts as a string
+    object (or NaN) and its pointer, like in an object column, and a float32
+    column counts as float64.
+
+    Args:
+        df (pandas.DataFrame): right table
+
+    Returns:
+        float: memory usage in MB
+    """
+    usage = df.memory_usage(deep=True)
+    for column in df.columns:
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            sizes = np.array([sys.getsizeof(value) for value in series.cat.categories]
+                             + [sys.getsizeof(np.nan)], dtype=np.int64)
+            # the code of a missing value is -1, the size of NaN
+            usage[column] = sizes[series.array.codes].sum() + 8 * len(series)
+        elif series.dtype == np.float32:
+            usage[column] = 8 * len(series)
+    return usage.sum() / 1024.0 ** 2
+
+
+def print_memory_report(df, before=None):
+    """Print the memory used by the right table before and after compaction
+
+    Args:
+        df (pandas.DataFrame): right table
+        before (float): memory usage of the parsed table in MB, estimated
+            from df if None
+    """
+    if before is None:
+        before = parsed_memory_usage_mb(df)
+    after = memory_usage_mb(df)
+    print('memory usage of the right table: {:.1f} MB as parsed, {:.1f} MB in memory '
+          '({:.0%})'.format(before, after, after / before))
+
+
+def compact_mobility_frame(df):
+    """Convert the right table to a compact in-memory representation
+
+    The repeated string columns become categoricals and the metric columns
+    float32. The date column is kept as a categorical of strings instead of
+    datetime64, since it is joined with the string dates of the left table
+    and each value only takes 2 bytes that way. The columns are converted in
+    place, one at a time, so the table is not copied as a whole.
+
+    Args:
+        df (pandas.DataFrame): parsed right table
+
+    Returns:
+        pandas.DataFrame: compact df
+    """
+    for column, dtype in compact_mobility_dtypes().items():
+        if column in df.columns:
+            df[column] = df[column].astype(dtype)
+
+    return df
+
+
+def file_mtimes(paths):
+    """Modification times of files
+
+    Args:
+        paths (list(str)): paths of the files
+
+    Returns:
+        tuple(float): modification times, None for a missing file
+    """
+    return tuple(os.path.getmtime(path) if os.path.isfile(path) else None
+                 for path in paths)
+
+
+def mobility_source_mtimes():
+    """Modification times of the files the right table is loaded from
+
+    Returns:
+        tuple(float): modification times, None for a missing file
+    """
+    return file_mtimes(mobility_source_files)
+
+
+def alias_source_mtimes():
+    """Modification times of the left tables of the alias index
+
+    Returns:
+        tuple(float): modification times, None for a missing file
+    """
+    return file_mtimes(alias_source_files)
+
+
+def remove_old_mobility_caches():
+    """Remove the right tables cached by the other versions of parse_mobility_data"""
+    cache_path = mobility_source_files[1]
+    for path in glob.glob('right.csv') + glob.glob('right.v*.csv'):
+        if path == cache_path:
+            continue
+        try:
+            os.remove(path)
+            logging.warning('removed {}, parsed by another version of parse_mobility_data'.format(path))
+        except OSError:
+            # still open by another process on Windows
+            pass
+
+
+def load_mobility_data(compact=False, memory_report=False):
+    """Load the parsed Google Mobility Data (right table)
+
+    The parsed data is cached in right.v<version>.csv to improve the
+    performance at the next running time. The cache is refreshed if the
+    source file is newer, and the caches of the other versions of
+    parse_mobility_data are removed.
+
+    Args:
+        compact (bool): return the compact representation of the table
+        memory_report (bool): print the memory used by the table before and
+            after compaction. The usage before is measured when the source
+            file is parsed, and estimated when the cache is read
+
+    Returns:
+        pandas.DataFrame: parsed df
+    """
+    source_path, cache_path = mobility_source_files
+    before = None
+    if os.path.isfile(cache_path) and (not os.path.isfile(source_path) or
+            os.path.getmtime(cache_path) >= os.path.getmtime(source_path)):
+        # read the compact representation directly, so that the full table
+        # is never in memory
+        dtype = compact_mobility_dtypes() if compact else None
+        df = pd.read_csv(cache_path, sep=',', header=0, encoding='utf-8', low_memory=False,
+                         dtype=dtype)
+    else:
+        df = parse_mobility_data(source_path)
+        # other processes may be reading the cache, and a partially written
+        # cache would look newer than the source, so it is replaced at once
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        df.to_csv(tmp_path, encoding='utf-8', index=False)
+        os.replace(tmp_path, cache_path)
+        remove_old_mobility_caches()
+        if compact:
+            before = memory_usage_mb(df) if memory_report else None
+            df = compact_mobility_frame(df)
+
+    if memory_report:
+        print_memory_report(df, before)
+    return df
+
+
+def load_mobility_data_and_mtimes(compact=False):
+    """Load the right table and the modification times of its files
+
+    The modification time of the source file is read before the load, so
+    that a change of the source while it is parsed is detected by the next
+    comparison with mobility_source_mtimes. The one of the cache is read
+    after the load, since load_mobility_data may rewrite it.
+
+    Args:
+        compact (bool): return the compact representation of the table
+
+    Returns:
+        tuple(pandas.DataFrame, tuple(float)): parsed df and the modification
+            times of mobility_source_files
+    """
+    source_mtime = mobility_source_mtimes()[0]
+    df = load_mobility_data(compact=compact)
+    return df, (source_mtime,) + mobility_source_mtimes()[1:]
+
+
+def build_alias_index(df2):
+    """Build the alias index of the county names of all the sources
+
+    The index is built from the right table and the county names of the
+    NYTimes report and the JHU time series report.
+
+    Args:
+        df2 (pandas.DataFrame): parsed right table
+
+    Returns:
+        AliasIndex: index
+    """
+    nyt_path, jhu_path = alias_source_files
+    nyt = pd.read_csv(nyt_path, sep=',', encoding='utf-8', usecols=['state', 'county'])
+    nyt.rename({'state': 'sub_region_1', 'county': 'sub_region_2'}, axis='columns', inplace=True)
+
+    jhu = pd.read_csv(jhu_path, sep=',', encoding='utf-8', usecols=['Province_State', 'Admin2'])
+    jhu.rename({'Province_State': 'sub_region_1', 'Admin2': 'sub_region_2'}, axis='columns', inplace=True)
+
+    return AliasIndex.from_sources(df2, lefts=[nyt.drop_duplicates(), jhu.drop_duplicates()])
+
+
 def download_file():
     if (os.path.isdir('ground-truth')):
         logging.info('Data exists. No need to download again.')